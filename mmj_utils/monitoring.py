@@ -14,76 +14,110 @@
 # limitations under the License.
 
 from dataclasses import dataclass 
-from prometheus_client import start_http_server, Gauge
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.exposition import MetricsHandler
+from http.server import HTTPServer
+import numpy as np 
 import logging 
-from time import time 
+from threading import Lock, Thread 
+from time import monotonic 
 
 
+class _MetricsHandler(MetricsHandler):
+    """Prometheus metrics handler with a socket timeout so a stalled client cannot block the single serving thread."""
+    timeout = 10 
+
 @dataclass 
 class Alert:
     """Schema for websocket alerts"""
     string: str 
     state: int #1 or 0
     cooldown: bool 
-    trigger_time: int # time.time() stamp 
+    trigger_time: float # time.monotonic() stamp 
 
 class AlertMonitor:
-    """Class to handle true/false alert value output to prometheus"""
+    """Class to handle true/false alert value output to prometheus. Alert states are read from the monitor when prometheus scrapes."""
     def __init__(self, num_rules, port, cooldown_time=60):
         self.num_rules = num_rules
-        self.prometheus_metric = Gauge("alert_status", "test", ["alert_number", "alert_string"])
-        self.prometheus_metric.labels("", "") 
-        start_http_server(port)
-        self.alerts = {} #{"r0":Alert, ...}
         self.cooldown_time = cooldown_time 
+        self._lock = Lock() #guards alert arrays while they are replaced or scraped
+
+        #Alert data is stored as parallel arrays indexed through _key_to_idx
+        self._keys = []
+        self._strings = []
+        self._key_to_idx = {}
+        self._state = np.zeros(0, dtype=np.int8)
+        self._cooldown = np.zeros(0, dtype=bool)
+        self._trigger_time = np.zeros(0, dtype=np.float64) #nan when not triggered
+
+        REGISTRY.register(self)
+
+        #Serve scrapes sequentially from a single background thread instead of a new thread per scrape 
+        self._metrics_server = HTTPServer(("0.0.0.0", port), _MetricsHandler.factory(REGISTRY))
+        self._metrics_thread = Thread(target=self._metrics_server.serve_forever, daemon=True, name="Prometheus Server")
+        self._metrics_thread.start()
+
+    @property
+    def alerts(self):
+        """Snapshot of the current alerts {"r0":Alert, ...}"""
+        with self._lock:
+            return {key: Alert(string=self._strings[i], state=int(self._state[i]), cooldown=bool(self._cooldown[i]), 
+                               trigger_time=None if np.isnan(self._trigger_time[i]) else float(self._trigger_time[i])) 
+                    for i, key in enumerate(self._keys)}
 
     def set_alert_states(self, new_alert_states):
         """Updates alert states. new_alert_states {"r0": 0, "r1": 1}"""
-
-        for alert_key, new_alert_state in new_alert_states.items():
-            
-            if alert_key in self.alerts:
-                alert = self.alerts[alert_key]
-
-                if self.cooldown_time > 0:
-                    #Reset Cooldown
-                    if alert.cooldown:
-                        if time() - alert.trigger_time > self.cooldown_time:
-                            alert.cooldown = False 
-                            alert.trigger_time = None 
-                    else:
-                        if new_alert_state == 1:
-                            alert.trigger_time = time() 
-                            alert.cooldown = True 
-
-                alert.state = new_alert_state 
-
-                self.alerts[alert_key].state = new_alert_state  #update alert state value 
-      
-        self._update_prometheus(self.alerts)
+        now = monotonic() #one timestamp per update, immune to wall clock jumps 
+
+        with self._lock:
+            new_state = self._state.copy()
+            present = np.zeros(len(self._keys), dtype=bool) #alerts included in this update
+            for alert_key, new_alert_state in new_alert_states.items():
+                idx = self._key_to_idx.get(alert_key)
+                if idx is not None:
+                    new_state[idx] = new_alert_state
+                    present[idx] = True 
+
+            if self.cooldown_time > 0:
+                #Reset expired cooldowns, otherwise start a cooldown for newly triggered alerts 
+                cooling = present & self._cooldown
+                expired = cooling & ((now - self._trigger_time) > self.cooldown_time)
+                triggered = present & ~cooling & (new_state == 1)
+                self._cooldown = (self._cooldown & ~expired) | triggered 
+                self._trigger_time = np.where(expired, np.nan, np.where(triggered, now, self._trigger_time))
+
+            self._state = new_state 
 
     def set_alerts(self, alert_strings):
         """Set alert strings. input alert_strings {"r0": "is there fire?", "r1": "is there smoke?" ...}"""
-        self.clear_alerts()
-
-        for key in alert_strings:
-            self.alerts[key] = Alert(string=alert_strings[key], state=0, cooldown=False, trigger_time=None)
-
-    def _update_prometheus(self, alerts):
-        """Update prometheus metrics with alert states. input alerts dict:  {"r0": Alert, "r1":Alert ...}"""
-        for k, v in alerts.items():
-            self.prometheus_metric.labels(k, v.string).set(v.state)
+        keys = list(alert_strings)
+        with self._lock:
+            self._keys = keys
+            self._strings = [alert_strings[key] for key in keys]
+            self._key_to_idx = {key: i for i, key in enumerate(keys)}
+            self._state = np.zeros(len(keys), dtype=np.int8)
+            self._cooldown = np.zeros(len(keys), dtype=bool)
+            self._trigger_time = np.full(len(keys), np.nan, dtype=np.float64)
 
     def clear_alerts(self):
-        "Set all alerts to false"
-        old_alerts = self.alerts 
-        self.alerts = {}
-
-        for key in old_alerts:
-            old_alerts[key].state = 0
-        
-        self._update_prometheus(old_alerts)
-
-
-
-
+        "Remove all alerts. Their series are dropped from the next scrape."
+        self.set_alerts({})
+
+    def describe(self):
+        """Metric families exported by the monitor. Lets the registry skip a collect() on register."""
+        return [GaugeMetricFamily("alert_status", "Alert state for each alert number", labels=["alert_number"]), 
+                GaugeMetricFamily("alert_info", "Alert string for each alert number", labels=["alert_number", "alert_string"])]
+
+    def collect(self):
+        """Called by prometheus_client on scrape. Builds the alert metrics from the current alert states."""
+        with self._lock:
+            keys, strings, state = self._keys, self._strings, self._state
+
+        status = GaugeMetricFamily("alert_status", "Alert state for each alert number", labels=["alert_number"])
+        info = GaugeMetricFamily("alert_info", "Alert string for each alert number", labels=["alert_number", "alert_string"]) #info metric, value is always 1
+        for key, string, value in zip(keys, strings, state.tolist()):
+            status.add_metric([key], value)
+            info.add_metric([key, string], 1)
+        yield status 
+        yield info 
@@ -14,14 +14,22 @@
 # limitations under the License.
 
 from jetson_utils import cudaFont, cudaDrawRect #cuda accelerated functions 
-from jetson_utils import cudaFromNumpy
+from jetson_utils import cudaFromNumpy, cudaImage
 import matplotlib.pyplot as plt
 import numpy as np
 import torch 
+import textwrap 
+from collections import OrderedDict 
 
 
 __all__ = ["DetectionOverlayCUDA", "VLMOverlay"]
 
+class _FontFilterTable(dict):
+    """str.translate table mapping characters outside ascii codes 32-254 to a space. Filled lazily so it only holds characters that were seen."""
+    def __missing__(self, code):
+        self[code] = code if 32 <= code <= 254 else ord(' ')
+        return self[code]
+
 def _cudaFromTorch(tensor):
     """
     https://github.com/dusty-nv/jetson-utils/blob/master/python/examples/cuda-from-pytorch.py
@@ -38,7 +46,7 @@ def _cudaFromTorch(tensor):
     elif len(tensor.shape) == 2:   # HW layout
         channels = 1
     else:
-        raise ValueError(f"PyTorch tensor should have at least 2 image dimensions (has {tensor.shape.length})")
+        raise ValueError(f"PyTorch tensor should have at least 2 image dimensions (has {len(tensor.shape)})")
         
     if channels == 1:
         im_format = 'gray32f' if tensor.dtype == torch.float32 else 'gray8'
@@ -46,15 +54,17 @@ def _cudaFromTorch(tensor):
         im_format = 'rgb32f'  if tensor.dtype == torch.float32 else 'rgb8'
     elif channels == 4: 
         im_format = 'rgba32f' if tensor.dtype == torch.float32 else 'rgba8'
-    
-    raise ValueError(f"PyTorch tensor should have 1, 3, or 4 image channels (has {channels})")
-    cuda_img = cudaImage(ptr=tensor.data_ptr(), width=tensor.shape[-1], height=tensor.shape[-2], format=tensor_image_format(tensor))
+    else:
+        raise ValueError(f"PyTorch tensor should have 1, 3, or 4 image channels (has {channels})")
+
+    cuda_img = cudaImage(ptr=tensor.data_ptr(), width=tensor.shape[-1], height=tensor.shape[-2], format=im_format)
     return cuda_img
 
 
 
 
 class VLMOverlay:
+    _FILTER_TABLE = _FontFilterTable()
 
     def __init__(self, **kwargs):
         """
@@ -105,8 +115,8 @@ class VLMOverlay:
         self.alpha = 255
 
         #text output 
-        self._input_text = None 
-        self._output_text = None 
+        self.input_text = None 
+        self.output_text = None 
    
     @property
     def input_text(self):
@@ -115,6 +125,7 @@ class VLMOverlay:
     @input_text.setter
     def input_text(self, text):
         self._input_text = text 
+        self._prepare_input_text()
 
     @property
     def output_text(self):
@@ -123,48 +134,65 @@ class VLMOverlay:
     @output_text.setter
     def output_text(self, text):
         self._output_text = text
+        self._prepare_output_text()
+
+    @property
+    def input_prefix(self):
+        return self._input_prefix
+
+    @input_prefix.setter
+    def input_prefix(self, prefix):
+        self._input_prefix = prefix 
+        if hasattr(self, "_input_text"):
+            self._prepare_input_text()
+
+    @property
+    def output_prefix(self):
+        return self._output_prefix
+
+    @output_prefix.setter
+    def output_prefix(self, prefix):
+        self._output_prefix = prefix 
+        if hasattr(self, "_output_text"):
+            self._prepare_output_text()
+
+    def _prepare_input_text(self):
+        """Builds the prefixed and filtered input text, dropping lines wrapped from the previous text."""
+        self._input_draw_text = self._filter_string(f"{self._input_prefix} {self._input_text}")
+        self._input_lines = {} #wrapped lines memoized by line length
+
+    def _prepare_output_text(self):
+        """Builds the prefixed and filtered output text, dropping lines wrapped from the previous text."""
+        self._output_draw_text = self._filter_string(f"{self._output_prefix} {self._output_text}")
+        self._output_lines = {} #wrapped lines memoized by line length
 
     def _filter_string(self, text):
         """cuda font only supports ascii codes 32-254 """
-        return ''.join([ch if 32 <= ord(ch) <= 254 else ' ' for ch in text])
+        return text.translate(self._FILTER_TABLE)
 
+    def _wrap_text(self, text, line_length):
+        """Split text across lines at word boundaries"""
+        return textwrap.wrap(" ".join(text.split()), width=line_length, break_long_words=False) or [""]
 
-    def _draw_lines(self, image, text, x, y, **kwargs):
-        """"Draw text on a image with word wrapping"""
+    def _get_lines(self, line_cache, text, line_length):
+        """Get wrapped lines for text. Only wraps again when the line length changes."""
+        lines = line_cache.get(line_length)
+        if lines is None:
+            lines = line_cache[line_length] = self._wrap_text(text, line_length)
+        return lines
 
-        if text is None:
-            return y
-        
-        text_color=kwargs.get("text_color", self.font.White) 
-        background_color=kwargs.get("background_color", self.font.Gray40)
-        line_spacing = kwargs.get("line_spacing", 42)
-        line_length = (image.width-x) // 16 if kwargs.get("line_length") is None else kwargs.get("line_length")
-        alpha = kwargs.get("alpha", 255)
+    def _draw_prepared_lines(self, image, lines, x, y, text_color, background_color, line_spacing, alpha):
+        """"Draw already wrapped lines of text on a image"""
 
         #Add transparency 
         text_color = text_color[:3] + (alpha,)
         background_color = background_color[:3] + (alpha,)
 
-        #Split text across lines at word boundaries 
-        text = text.split()
-        current_line = ""
-        line_count = 0
-        for word in text:
-            if len(current_line) + len(word) <= line_length:
-                current_line = current_line + word + " "
-            else:
-                current_line = current_line.strip()
-                self.font.OverlayText(image, text=current_line, x=x, y=y, color=text_color, background=background_color)
-                current_line = word + " "
-                line_count+=1
-                y=y+line_spacing
-        
-        
-        current_line = current_line.strip() 
-        current_line = self._filter_string(current_line)
-        self.font.OverlayText(image, text=current_line, x=x, y=y, color=text_color, background=background_color)
+        for line in lines:
+            self.font.OverlayText(image, text=line, x=x, y=y, color=text_color, background=background_color)
+            y=y+line_spacing
 
-        return y+line_spacing #return Y offset for next line start 
+        return y #return Y offset for next line start 
 
     def reset_decay(self):
         """Reset the text alpha decay."""
@@ -188,8 +216,16 @@ class VLMOverlay:
         if output_required and self._output_text is None:
             return image 
 
-        y_offset = self._draw_lines(image, f"{self.input_prefix} {self._input_text}", self.x, self.y, text_color=self.input_text_color, background_color=self.input_background_color, line_spacing=self.line_spacing, line_length=self.line_length, alpha=self.alpha)
-        self._draw_lines(image, f"{self.output_prefix} {self._output_text}", self.x, y_offset, text_color=self.output_text_color, background_color=self.output_background_color, line_spacing=self.line_spacing, line_length=self.line_length, alpha=self.alpha)
+        #Text has fully decayed, skip launching transparent text overlays 
+        if self.alpha <= 0:
+            return image 
+
+        line_length = (image.width-self.x) // 16 if self.line_length is None else self.line_length
+        input_lines = self._get_lines(self._input_lines, self._input_draw_text, line_length)
+        output_lines = self._get_lines(self._output_lines, self._output_draw_text, line_length)
+
+        y_offset = self._draw_prepared_lines(image, input_lines, self.x, self.y, self.input_text_color, self.input_background_color, self.line_spacing, self.alpha)
+        self._draw_prepared_lines(image, output_lines, self.x, y_offset, self.output_text_color, self.output_background_color, self.line_spacing, self.alpha)
 
         if decay:
             self.alpha = max(0, self.alpha - self.decay_rate)
@@ -211,6 +247,7 @@ class DetectionOverlayCUDA:
             text_offset_y (int): Text offset in the y direction from the top left of the associated bbox. Can be + or -
             text_offset_x (int): Text offset in the x direction from the top left of the associated bbox. Can be + or -
             max_objects (int): Expected unique objects. If the number of unique objects exceeds this value, then bounding box colors will repeat. If the value is too high then the color difference between bboxes will be very small. 
+            max_object_classes (int): Maximum number of object labels to remember colors for. The least recently drawn label is forgotten when exceeded. 
 
         Returns:
             None
@@ -226,14 +263,13 @@ class DetectionOverlayCUDA:
         self.max_objects = kwargs.get("max_objects", 10) #Used for color mapping. If value is lower than the number object classes, then colors will repeat. Set to higher value if you don't want duplicate colors. 
         
         cmap = plt.get_cmap("rainbow", self.max_objects)  #color map for bounding boxes 
-        self.cmap = []
-        for i in range(self.max_objects):
-            color = cmap(i)
-            color = [int(255 * value) for value in color]
-            self.cmap.append(tuple(color))
+        colors = (np.asarray(cmap(np.arange(self.max_objects))) * 255).astype(np.uint8)
+        self.cmap = [tuple(color) for color in colors.tolist()]
 
         self.font = cudaFont(size=self.text_size)
-        self.object_classes = {}
+        self.max_object_classes = kwargs.get("max_object_classes", 1024)
+        self.object_classes = OrderedDict() #normalized object label -> bbox color, least recently drawn first 
+        self._class_counter = 0 #number of labels assigned a color so far
 
     #TODO handle image input errors/wrong types etc 
     def __call__(self, image, objects, bboxes):
@@ -253,30 +289,42 @@ class DetectionOverlayCUDA:
             raise Exception("objects and bboxes not the same length.")
         
         #Convert tensor or np array to cudaImage
-        if type(image) == torch.Tensor:
+        if isinstance(image, torch.Tensor):
             image = _cudaFromTorch(image)
-        elif type(image) == np.ndarray:
+        elif isinstance(image, np.ndarray):
             image = cudaFromNumpy(image)
         
-        #Loop through objects and draw bboxes & labels 
-        for i in range(len(objects)):
-            box = bboxes[i]
-            obj = objects[i]
+        #Bind attributes used in the per object loop to locals
+        draw_bbox = self.draw_bbox
+        draw_text = self.draw_text
+        bbox_width = self.bbox_width
+        offset_x, offset_y = self.text_offset_x, self.text_offset_y
+        overlay_text = self.font.OverlayText
+        cmap = self.cmap
+        classes = self.object_classes
+        max_classes = self.max_object_classes
 
+        #Loop through objects and draw bboxes & labels 
+        for obj, box in zip(objects, bboxes):
             #Add to obj to dict to track color mapping if not there already
-            if obj not in self.object_classes:
-                self.object_classes[obj] = len(self.object_classes)
+            key = obj.strip().lower()
+            color = classes.get(key)
+            if color is None:
+                if len(classes) >= max_classes:
+                    classes.popitem(last=False)
+                color = classes[key] = cmap[self._class_counter % len(cmap)]
+                self._class_counter += 1
+            else:
+                classes.move_to_end(key)
 
-            box = [int(x) for x in box]
-            box = tuple(box) 
-            color = self.cmap[self.object_classes[obj]%len(self.cmap)]
+            box = (int(box[0]), int(box[1]), int(box[2]), int(box[3]))
 
-            if self.draw_bbox:
-                cudaDrawRect(image, box, line_color=color, line_width=self.bbox_width)
+            if draw_bbox:
+                cudaDrawRect(image, box, line_color=color, line_width=bbox_width)
 
-            if self.draw_text:
-                self.font.OverlayText(image, text=obj, 
-                            x=box[0]+self.text_offset_x, y=box[1]+self.text_offset_y,
+            if draw_text:
+                overlay_text(image, text=obj, 
+                            x=box[0]+offset_x, y=box[1]+offset_y,
                             color=color, background=(0,0,0,0))
 
         return image 
@@ -14,8 +14,11 @@
 # limitations under the License.
 
 import redis 
-import datetime 
-import json
+from time import time_ns, gmtime, strftime 
+from threading import Thread 
+import logging 
+import queue 
+import orjson
 
 __all__ = ["SchemaGenerator"]
 
@@ -32,6 +35,8 @@ class SchemaGenerator:
             redis_stream (str): Redis Stream name to output metadata
             redis_host (str): Redis server host to connect to 
             redis_port (int): Port of redis server
+            batch_size (int): Maximum number of queued metadata messages written to redis in one pipeline
+            queue_size (int): Maximum metadata messages waiting to be written to redis. The oldest message is dropped when full.
 
         Returns:
             None
@@ -45,6 +50,9 @@ class SchemaGenerator:
         self.redis_connected = False
         self.frame_counter = 0
         self.id_counter = 0
+        self.batch_size = kwargs.get("batch_size", 1)
+        self._queue = queue.Queue(maxsize=kwargs.get("queue_size", 256)) #metadata waiting to be written to redis
+        self._writer = None 
 
         #If user supplied redis info then connect
         if self.redis_stream != None and self.redis_port != None and self.redis_stream!= None:
@@ -52,6 +60,20 @@ class SchemaGenerator:
 
         self.frame_id = 0
 
+        #Cached "YYYY-MM-DDTHH:MM:SS" prefix for the current second 
+        self._ts_second = None 
+        self._ts_prefix = ""
+
+    @property
+    def sensor_id(self):
+        return self._sensor_id 
+
+    @sensor_id.setter
+    def sensor_id(self, sensor_id):
+        """Sets the sensor id and rebuilds the static part of the frame schema, which is serialized once per sensor id."""
+        self._sensor_id = sensor_id 
+        self._schema_prefix = b'{"version":"4.0","sensorId":' + orjson.dumps(sensor_id) + b',"objects":'
+
     def connect_redis(self, host, port, stream):
         """
         Connects object to a redis server. 
@@ -65,41 +87,84 @@ class SchemaGenerator:
             none
         """
         self.redis_stream = stream 
-        self.redis_server = redis.Redis(host=host, port=port, decode_responses=True)
+        self.redis_server = redis.Redis(host=host, port=port)
         self.redis_connected = True
 
+        #Redis writes happen on a background thread so a slow server does not stall the caller 
+        if self._writer is None:
+            self._writer = Thread(target=self._redis_writer, daemon=True, name="Redis Writer")
+            self._writer.start()
+
+    def _timestamp(self):
+        """UTC timestamp in ms precision ex: 2024-01-01T00:00:00.000Z"""
+        seconds, ms = divmod(time_ns() // 1_000_000, 1000)
+        if seconds != self._ts_second:
+            self._ts_second = seconds 
+            self._ts_prefix = strftime("%Y-%m-%dT%H:%M:%S", gmtime(seconds))
+        return f"{self._ts_prefix}.{ms:03d}Z"
+
     def _gen_schema(self, objects, bboxes, object_ids = None, frame_id=None):
         if frame_id is None:
             frame_id = self.frame_counter
             self.frame_counter+=1
 
-        timestamp = datetime.datetime.utcnow()
-        timestamp = timestamp.isoformat("T")[0:-3] + "Z"
+        timestamp = self._timestamp()
         #sensor_schema = {"sensor":{"id":self.sensor_id, "type":self.sensor_type, "location":{"lat":self.sensor_loc[0], "lon":self.sensor_loc[1], "alt":self.sensor_loc[2]}}}
         
-        object_list = []
         if len(objects) != len(bboxes):
             raise Exception("objects and bboxes not the same length.")
 
-        for i in range(len(objects)):
-            box = bboxes[i]
-            obj = objects[i]
-            if object_ids:
-                obj_id = object_ids[i]
-            else:
-                obj_id = self.id_counter
-                self.id_counter += 1
-
-            object_schema = f"{obj_id}|{box[0]}|{box[1]}|{box[2]}|{box[3]}|{obj}"
-            #object_schema = {"bbox": {"leftX":box[0], "topY":box[1],"rightX":box[2], "bottomY":box[3]}, "type":obj}
-            object_list.append(object_schema)
+        #Convert numpy bbox arrays to python values in one call 
+        if hasattr(bboxes, "tolist"):
+            bboxes = bboxes.tolist()
+
+        if not object_ids:
+            object_ids = range(self.id_counter, self.id_counter + len(objects))
+            self.id_counter += len(objects)
+
+        #object_schema = {"bbox": {"leftX":box[0], "topY":box[1],"rightX":box[2], "bottomY":box[3]}, "type":obj}
+        object_list = [f"{obj_id}|{box[0]}|{box[1]}|{box[2]}|{box[3]}|{obj}" for obj_id, box, obj in zip(object_ids, bboxes, objects)]
     
-        frame_schema = {"version": "4.0", "id":frame_id, "@timestamp":timestamp, "sensorId": self.sensor_id, "objects":object_list}
-        frame_schema = json.dumps(frame_schema)
+        #{"version": "4.0", "sensorId": sensor_id, "objects": object_list, "@timestamp": timestamp, "id": frame_id}
+        frame_schema = b"".join((self._schema_prefix, orjson.dumps(object_list), b',"@timestamp":', orjson.dumps(timestamp), b',"id":', orjson.dumps(frame_id), b"}"))
         return frame_schema
 
     def _redis_out(self, metadata):
-        self.redis_server.xadd(self.redis_stream, {"metadata":metadata})
+        try:
+            self._queue.put_nowait(metadata)
+        except queue.Full:
+            #Drop the oldest metadata, stale frames are not useful downstream 
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+            except queue.Empty:
+                pass 
+            self._queue.put_nowait(metadata)
+
+    def _redis_writer(self):
+        """Runs as a background thread. Writes queued metadata to the redis stream, pipelining up to batch_size messages per round trip."""
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break 
+
+            try:
+                pipe = self.redis_server.pipeline(transaction=False)
+                for metadata in batch:
+                    pipe.xadd(self.redis_stream, {"metadata":metadata})
+                pipe.execute()
+            except Exception as e:
+                logging.error(f"Failed to write metadata to redis: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Block until all queued metadata has been written to the redis stream."""
+        self._queue.join()
     
     def __call__(self, objects, bboxes):
         """
@@ -110,7 +175,7 @@ class SchemaGenerator:
             bboxes (list[(int,int,int,int), ...]): List of bounding boxes. Each bounding box should be in this format (x1, y1, x2, y2) Where x1,y1 is the top left and x2,y2 is the bottom right coordinate of the bbox. 
 
         Returns:
-            out (str): A serialized json string with the metadata in Metropolis minimal schema. Will also write this to a redis stream if connected.
+            out (bytes): Serialized json with the metadata in Metropolis minimal schema. Will also write this to a redis stream if connected.
         """
         out = self._gen_schema(objects, bboxes)
       
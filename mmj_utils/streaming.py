@@ -13,22 +13,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from jetson_utils import videoSource, videoOutput, cudaAllocMapped, cudaDeviceSynchronize
-from threading import Thread 
+from jetson_utils import videoSource, videoOutput, cudaAllocMapped, cudaToNumpy
+from threading import Thread, Event, Lock 
 import logging 
-from time import sleep 
-import queue 
+from time import sleep, monotonic 
+
+#CUDA stream bindings are only available in newer jetson_utils releases 
+try:
+    from jetson_utils import cudaStreamCreate, cudaStreamDestroy
+except ImportError:
+    cudaStreamCreate = cudaStreamDestroy = None 
 
 class VideoSource:
 
-    def __init__(self, url=None):
-        """Initialize video source object. If url supplied, it will attempt to connect. Otherwise call connect_stream to connect after initialization."""
+    def __init__(self, url=None, reconnect_time=2):
+        """
+        Initialize video source object. If url supplied, it will attempt to connect. Otherwise call connect_stream to connect after initialization.
+        reconnect_time: Seconds without a successfully captured frame before reconnecting to the stream in the background.
+        """
 
         self.v_input = None 
         self.url = url 
         self.connected = False 
         self.camera_name = None 
         self.camera_id = None 
+        self.reconnect_time = reconnect_time 
+        self._last_capture_ok = 0.0 #monotonic time of the last successful capture
+        self._reconnecting = False 
+        self.stream = None #CUDA stream for processing this source's frames, created on connect
 
         if self.url is not None:
             self.connect_stream(self.url)
@@ -46,6 +58,10 @@ class VideoSource:
             self.camera_name = None 
             self.camera_id = None 
 
+        if self.stream is not None:
+            cudaStreamDestroy(self.stream)
+            self.stream = None 
+
     def connect_stream(self, url, retries=5, camera_name="", camera_id=""):
         """Closes current stream if available and tries to connect to a new one """
         count = 0
@@ -68,22 +84,32 @@ class VideoSource:
                 self.url = url 
                 self.camera_name = camera_name 
                 self.camera_id = camera_id 
+                self._last_capture_ok = monotonic()
+                if self.stream is None and cudaStreamCreate is not None:
+                    self.stream = cudaStreamCreate()
                 logging.info("Successfully connected to stream")
                 return 
             
             except Exception as e:
                 logging.info(f"Failed to create video source")
-                sleep(0.5)
+                sleep(min(0.1 * 2**count, 5.0)) #exponential backoff between attempts
             
             count+=1
         logging.error("Failed to connect to stream")
         return 
 
 
-    def __call__(self,retries=8):
-        """Returns the most recent frame from the connected stream"""
+    def _reconnect(self):
+        """Runs as a background thread to reconnect to the current stream."""
+        try:
+            self.connect_stream(self.url, camera_name=self.camera_name, camera_id=self.camera_id)
+        finally:
+            self._reconnecting = False 
 
-        if self.v_input is None:
+    def __call__(self,retries=2):
+        """Returns the most recent frame from the connected stream. Returns None if capture fails or the stream is reconnecting."""
+
+        if self.v_input is None or self._reconnecting:
             #logging.info("Called VideoSource but not connected to stream.")
             return None 
         
@@ -91,44 +117,88 @@ class VideoSource:
         while count < retries:
             try:
                 frame = self.v_input.Capture()
+                self._last_capture_ok = monotonic()
                 return frame 
             except Exception as e:
                 frame = None 
             count+=1
-        #Failed to get frame 
+
+        #Failed to get frame. Only reconnect once the stream has been failing for reconnect_time 
+        if monotonic() - self._last_capture_ok < self.reconnect_time:
+            return None 
+
         logging.error("Failed to get frame from input stream. Reconnecting.")
-        self.connect_stream(self.url, camera_name=self.camera_name, camera_id=self.camera_id)
+        self._reconnecting = True 
+        Thread(target=self._reconnect, daemon=True, name="Stream Reconnect").start()
         return None 
 
 class VideoOutput:
+    _backup_frames = {} #black frames shared by all outputs {(width, height): cudaImage}
+    _backup_lock = Lock()
 
     def __init__(self, url):
         """Initialize an output RTSP stream."""
         self.url = url 
 
-        self.frame_queue = queue.Queue(maxsize = 3) 
+        #Latest frame to render. New frames replace any frame that has not been rendered yet.
+        self._latest_frame = None 
+        self._new_frame = Event()
 
         self.v_output = videoOutput(self.url, options={'save': '/tmp/null.mp4'})
         self.timeout = 1/5 
-        self.backup_frame = cudaAllocMapped(width=1920, height=1080, format="rgb8")
-        cudaDeviceSynchronize()
+        self.stream = cudaStreamCreate() if cudaStreamCreate is not None else None #CUDA stream for processing this output's frames
+        self.backup_size = (1920, 1080) #size of the black frame output when no frames arrive. Follows the last rendered frame.
 
+        self._closed = Event()
         self.thread = Thread(target=self._stream_out, daemon=True)
         self.thread.start() 
 
+    def close(self):
+        """Stop rendering, close the output stream and release the CUDA stream."""
+        self._closed.set()
+        self._new_frame.set() #wake the render thread so it sees the close 
+        self.thread.join(timeout=5)
+        try:
+            self.v_output.Close()
+        except Exception as e:
+            logging.error("Failed to close output stream")
+
+        if self.stream is not None:
+            cudaStreamDestroy(self.stream)
+            self.stream = None 
+
+    @classmethod
+    def _get_backup_frame(cls, width, height):
+        """Get a black frame of the given size. Frames are allocated and zeroed once, then reused by every output."""
+        frame = cls._backup_frames.get((width, height))
+        if frame is None:
+            with cls._backup_lock:
+                frame = cls._backup_frames.get((width, height))
+                if frame is None:
+                    frame = cudaAllocMapped(width=width, height=height, format="rgb8")
+                    cudaToNumpy(frame).fill(0) #zeroed from the host through mapped memory, no device sync needed
+                    cls._backup_frames[(width, height)] = frame 
+        return frame 
+
     def _stream_out(self):
-        """Runs as a background thread to keep a persistent RTSP output. Will output a black frame if nothing is in the output queue."""
-        while True:
+        """Runs as a background thread to keep a persistent RTSP output. Will output a black frame if no new frame arrives within the timeout."""
+        while not self._closed.is_set():
             try:
-                frame = self.frame_queue.get(timeout=self.timeout)
-                self.v_output.Render(frame)
-            except queue.Empty: #todo only catch queue timeout handle others differently 
-                self.v_output.Render(self.backup_frame)
+                if self._new_frame.wait(timeout=self.timeout):
+                    self._new_frame.clear()
+                    if self._closed.is_set():
+                        break 
+                    frame = self._latest_frame 
+                    self.v_output.Render(frame)
+                    self.backup_size = (frame.width, frame.height)
+                else:
+                    self.v_output.Render(self._get_backup_frame(*self.backup_size))
 
             except Exception as e:
                 logging.error(e)
                 sleep(self.timeout)
 
     def __call__(self, frame):
-        """Call to place frame in the output queue to render on RTSP stream."""
-        self.frame_queue.put(frame)
\ No newline at end of file
+        """Call to set the next frame to render on RTSP stream. Replaces the pending frame if it has not been rendered yet."""
+        self._latest_frame = frame 
+        self._new_frame.set()
\ No newline at end of file
@@ -16,26 +16,89 @@
 import io 
 import base64
 import logging 
+import orjson 
 import requests 
-from threading import Thread 
+from requests.adapters import HTTPAdapter 
+from threading import Thread, Lock 
+from dataclasses import dataclass, field 
+from typing import Callable, Optional 
+import queue 
 from PIL import Image 
+import numpy as np 
 from .api_schemas import ChatContentImage, ChatContentImageOptions, ChatMessages 
 
-from jetson_utils import cudaToNumpy
+from jetson_utils import cudaToNumpy, cudaAllocMapped, cudaResize, cudaDeviceSynchronize
+
+#CUDA stream bindings are only available in newer jetson_utils releases 
+try:
+    from jetson_utils import cudaStreamSynchronize
+except ImportError:
+    cudaStreamSynchronize = None 
+
+#torchvision encodes CUDA tensors with nvjpeg. Optional, falls back to CPU encoding when unavailable. 
+try:
+    import torch 
+    from torchvision.io import encode_jpeg 
+except ImportError:
+    encode_jpeg = None 
+
+#OpenCV uses libjpeg-turbo for CPU encoding. Optional, falls back to PIL when unavailable. 
+try:
+    import cv2 
+    #OpenCV color conversions to BGR by channel count of the uint8 frame, other formats are encoded with PIL 
+    _CV2_TO_BGR = {(3,): cv2.COLOR_RGB2BGR, (4,): cv2.COLOR_RGBA2BGR}
+except ImportError:
+    cv2 = None 
+    _CV2_TO_BGR = {}
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+@dataclass 
+class Ego:
+    """System prompt and callback associated with an ego"""
+    system_prompt: str 
+    callback: Optional[Callable] = None 
+    callback_args: dict = field(default_factory=dict)
 
 class VLM:
     """Abstraction for the VLM chat server. Can use this object to track different 'egos' that have an associated system prompt and callback function."""
 
-    def __init__(self, url):
+    def __init__(self, url, target_size=None, stream=None):
+        """
+        url: Address of the chat server 
+        target_size: Optional (width, height) to resize frames to on the GPU before encoding. Set to the VLM input resolution to reduce request size.
+        stream: Optional CUDA stream to resize frames on, such as VideoSource.stream. Requires a jetson_utils release with CUDA stream support.
+        """
         self.url = url + "/v1/chat/completions"
         self.health_url = url + "/v1/health"
         self.egos = {}
-        self.busy = False 
+        self._session = requests.Session() #reuse connections to the chat server across calls 
+        self._session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self._inflight = Lock() #held while a request is in flight, released by the worker when it finishes
+        self._gpu_jpeg = self._check_gpu_jpeg() 
+        self._jpeg_buf = io.BytesIO() #reused across calls to PIL JPEG encoding 
+        self._bgr_buf = None #reused OpenCV color conversion output, reallocated when the frame shape changes
+        self._host_buf = None #reused host copy of the frame for PIL encoding
+        self._encode_lock = Lock()
+        self.target_size = target_size 
+        self._resize_buf = None #reused resize output, reallocated when the target size or format changes
+        self.stream = stream 
+
+        #Chat server requests are run by one persistent worker thread 
+        self._tasks = queue.SimpleQueue()
+        self._worker_thread = Thread(target=self._worker, daemon=True, name="VLM Worker")
+        self._worker_thread.start()
+
+    @property
+    def busy(self):
+        """True while a request is being processed."""
+        return self._inflight.locked()
 
     def health_check(self):
         """Check health endpoint of the chat server."""
         try:
-            response = requests.get(self.health_url)
+            response = self._session.get(self.health_url, timeout=(3, 10))
             if not response.ok:
                 return False
             
@@ -48,65 +111,178 @@ class VLM:
             return False 
 
 
+    def _resize_image(self, image):
+        """Resizes a cudaImage to target_size with bilinear filtering on the GPU."""
+        width, height = self.target_size 
+        if image.width == width and image.height == height:
+            return image 
+
+        buf = self._resize_buf 
+        if buf is None or buf.width != width or buf.height != height or buf.format != image.format:
+            buf = self._resize_buf = cudaAllocMapped(width=width, height=height, format=image.format)
+
+        #resized frame may be read from the CPU for encoding, so wait for the resize to finish 
+        if self.stream is not None and cudaStreamSynchronize is not None:
+            cudaResize(image, buf, filter="linear", stream=self.stream)
+            cudaStreamSynchronize(self.stream)
+        else:
+            cudaResize(image, buf, filter="linear")
+            cudaDeviceSynchronize()
+        return buf 
+
+    def _check_gpu_jpeg(self):
+        """Checks once whether JPEG encoding of CUDA tensors works. Older torchvision releases and builds without nvjpeg only encode on the CPU."""
+        if encode_jpeg is None:
+            return False 
+        try:
+            encode_jpeg(torch.zeros((3, 8, 8), dtype=torch.uint8, device="cuda"))
+            return True 
+        except Exception as e:
+            logging.info(f"GPU JPEG encoding is unavailable, using CPU encoding: {e}")
+            return False 
+
+    def _encode_jpeg_gpu(self, image):
+        """JPEG encodes a cudaImage on the GPU. Only the compressed bitstream is copied back to the host."""
+        tensor = torch.as_tensor(image, device="cuda").permute(2, 0, 1).contiguous() #HWC -> CHW 
+        return encode_jpeg(tensor, quality=75).cpu().numpy()
+
+    def _encode_jpeg_cpu(self, image):
+        """JPEG encodes a cudaImage on the CPU with OpenCV, or PIL if OpenCV is unavailable. Returns a buffer with the encoded bytes."""
+        image = cudaToNumpy(image) #view of mapped memory, which is uncached for CPU reads on Jetson 
+        if cv2 is not None:
+            #the color conversion is the single read from mapped memory, the encoder then reads the cached BGR buffer 
+            code = _CV2_TO_BGR.get(image.shape[2:]) if image.dtype == np.uint8 else None 
+            if code is not None:
+                shape = image.shape[:2] + (3,)
+                if self._bgr_buf is None or self._bgr_buf.shape != shape:
+                    self._bgr_buf = np.empty(shape, dtype=np.uint8)
+                bgr = cv2.cvtColor(image, code, dst=self._bgr_buf)
+                ok, jpeg = cv2.imencode(".jpg", bgr, [int(cv2.IMWRITE_JPEG_QUALITY), 75])
+                if ok:
+                    return jpeg 
+
+        #Copy out of mapped memory once so the encoder reads cached memory 
+        if self._host_buf is None or self._host_buf.shape != image.shape:
+            self._host_buf = np.empty(image.shape, dtype=image.dtype)
+        np.copyto(self._host_buf, image)
+
+        height, width = image.shape[:2]
+        if image.shape[2:] == (3,) and image.dtype == np.uint8:
+            image = Image.frombuffer("RGB", (width, height), self._host_buf, "raw", "RGB", 0, 1) #rgb8, skip fromarray mode inference 
+        else:
+            image = Image.fromarray(self._host_buf)
+        buf = self._jpeg_buf
+        buf.seek(0)
+        buf.truncate(0)
+        image.save(buf, format="JPEG")
+        return buf.getbuffer() #view of the encoded bytes without copying 
+
     def _encode_image(self, image):
         """Encodes input image as b64 for embedding in chat server request."""
-        #accepts cudaImage
-        image = cudaToNumpy(image)
-        image = Image.fromarray(image)
-        buf = io.BytesIO()
-        image.save(buf, format="JPEG")
-        image = buf.getvalue()
-        image = base64.b64encode(image).decode("utf-8")
+        #accepts cudaImage. Encoding buffers are reused so only one image is encoded at a time.
+        with self._encode_lock:
+            if self.target_size is not None:
+                image = self._resize_image(image)
+
+            jpeg = None 
+            if self._gpu_jpeg and image.format == "rgb8": #nvjpeg encodes 3 channel uint8 frames, others go to the CPU encoder 
+                try:
+                    jpeg = self._encode_jpeg_gpu(image)
+                except torch.cuda.OutOfMemoryError as e:
+                    logging.warning(f"GPU JPEG encoding failed, using CPU encoding for this frame: {e}")
+                except Exception as e:
+                    logging.warning(f"GPU JPEG encoding failed, falling back to CPU encoding: {e}")
+                    self._gpu_jpeg = False 
+
+            if jpeg is None:
+                jpeg = self._encode_jpeg_cpu(image)
+
+            image = base64.b64encode(jpeg).decode("ascii")
+            del jpeg #release any view on the reused JPEG buffer 
+
         logging.info("Encoded image")
         return image
 
     def add_ego(self, name, system_prompt="You are a helpful AI assistant.", callback=None, callback_args=None, history=None):
         """Add a new ego with an associated system prompt and callback function"""
-        self.egos[name] = {"system_prompt": system_prompt, "callback":callback, "callback_args":callback_args}
+        self.egos[name] = Ego(system_prompt=system_prompt, callback=callback, callback_args=callback_args or {})
 
     def replace_images(self, chat_completion, images):
         """Replace all stream type content with the base64 encoded frame"""
         image_counter = 0
-        for m, message in enumerate(chat_completion.messages):
+        encoded = {} #image data URIs by image id so a frame referenced more than once is only encoded once 
+        for message in chat_completion.messages:
             if isinstance(message.content, str):
                 continue 
             elif isinstance(message.content, list):
-                for c, content in enumerate(message.content):
-                    if content.type=="stream":
-                        if images is None or image_counter >= len(images):
-                            logging.info("Not enough images were supplied with the chat completion prompt. Skipping stream content replacement.")
-                            del chat_completion.messages[m].content[c]
-                            continue 
-                        image = images[image_counter]
-                        image = self._encode_image(image)
-                        image_string = f"data:image/jpeg;base64,{image}"
-                        image_content = ChatContentImage(type="image_url", image_url=ChatContentImageOptions(url=image_string))
-                        chat_completion.messages[m].content[c] = image_content
-                        image_counter += 1
+                #Rebuild the content list instead of deleting from it while iterating 
+                new_content = []
+                for content in message.content:
+                    if content.type!="stream":
+                        new_content.append(content)
+                        continue 
+                    if images is None or image_counter >= len(images):
+                        logging.info("Not enough images were supplied with the chat completion prompt. Skipping stream content replacement.")
+                        continue 
+                    image = images[image_counter]
+                    if id(image) not in encoded:
+                        encoded[id(image)] = f"data:image/jpeg;base64,{self._encode_image(image)}"
+                    image_string = encoded[id(image)]
+                    new_content.append(ChatContentImage(type="image_url", image_url=ChatContentImageOptions(url=image_string)))
+                    image_counter += 1
+                message.content = new_content 
             else:
                 logging.info("Invalid content format")
                 
         return chat_completion 
 
+    def _post_chat(self, body):
+        """Posts a serialized chat completions request. Streamed (server-sent event) responses are parsed as they arrive and merged into a single chat completions response."""
+        with self._session.post(self.url, data=body, headers=_JSON_HEADERS, timeout=(3, 60), stream=True) as response:
+            if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                logging.debug(response.text)
+                return orjson.loads(response.content)
+
+            role = "assistant"
+            content = [] #content deltas, joined once the stream finishes
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue 
+                data = line[6:]
+                if data == b"[DONE]":
+                    break 
+                choices = orjson.loads(data).get("choices")
+                if not choices:
+                    continue 
+                delta = choices[0].get("delta", {})
+                role = delta.get("role") or role 
+                if delta.get("content"):
+                    content.append(delta["content"])
+                if choices[0].get("finish_reason") is not None:
+                    break 
+
+        content = "".join(content)
+        logging.debug(content)
+        return {"choices": [{"index": 0, "message": {"role": role, "content": content}}]}
+
     def _call_chat_completion(self, ego, chat_completion, images, callback_args={}):
         """Calls chat server chat completions object followed up by the associated ego callback function"""
         try:
+            ego = self.egos[ego]
             chat_completion = self.replace_images(chat_completion, images)
-            response = requests.get(self.url, json=chat_completion.dict())
-            logging.debug(response.text)
-            response = response.json() 
+            response = self._post_chat(orjson.dumps(chat_completion.model_dump(mode="json", exclude_none=True)))
       
-            if (callback:=self.egos[ego]["callback"]):
-                callback_args.update(self.egos[ego]["callback_args"])
-                callback(response, **callback_args) #unpack dict of args as kwargs 
+            if (callback:=ego.callback):
+                callback(response, **{**callback_args, **ego.callback_args}) #unpack dict of args as kwargs 
         except Exception as e:
             logging.error(e)
-            self.busy = False 
-        self.busy = False 
+        finally:
+            self._inflight.release()
 
     def _call_str(self, ego, message, image, callback_args={}):
         """Calls chat server with text and image input followed up by associated ego callback function"""
         try:
+            ego = self.egos[ego]
             txt_msg = {"type":"text", "text":message}
             if image:
                 image = self._encode_image(image)
@@ -115,26 +291,29 @@ class VLM:
             else:
                 user_msg = {"role": "user", "content":[txt_msg]}
 
-            sys_msg = {"role":"system", "content":self.egos[ego]["system_prompt"]}
-            response = requests.get(self.url, json={"messages":[sys_msg, user_msg]})
-            logging.debug(response.text)
-            response = response.json()["choices"][0]["message"]["content"]
+            sys_msg = {"role":"system", "content":ego.system_prompt}
+            response = self._post_chat(orjson.dumps({"messages":[sys_msg, user_msg]}))
+            response = response["choices"][0]["message"]["content"]
             response = response.replace("\n", "").replace("</s>", "").strip() 
       
-            if (callback:=self.egos[ego]["callback"]):
-                callback_args.update(self.egos[ego]["callback_args"])
-                callback(response, **callback_args) #unpack dict of args as kwargs 
+            if (callback:=ego.callback):
+                callback(response, **{**callback_args, **ego.callback_args}) #unpack dict of args as kwargs 
         except Exception as e:
             logging.error(e)
-            self.busy = False 
-        self.busy = False 
+        finally:
+            self._inflight.release()
+
+    def _worker(self):
+        """Runs as a background thread. Calls the chat server for each queued request."""
+        while True:
+            fn, args = self._tasks.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error(f"VLM worker task failed: {e}")
 
     def __call__(self, ego, message, images=None, **kwargs):
         """Call the VLM with the ego. Message can be a simple string prompt and image or a Chat Completion object."""
-        if self.busy:
-            logging.info("VLM is busy")
-            return None
-        
         if ego not in self.egos:
             logging.info("Ego does not exist. Add it first.")
             return None 
@@ -143,9 +322,11 @@ class VLM:
             logging.info("Message is an unsupported type")
             return None 
 
-        else:
-            self.busy = True 
-            if isinstance(message, ChatMessages):
-                Thread(target=self._call_chat_completion, args=(ego, message, images, kwargs)).start() #pass kwargs as dict to callback 
-            if isinstance(message, str):
-                Thread(target=self._call_str, args=(ego, message, images, kwargs)).start() #pass kwargs as dict to callback 
\ No newline at end of file
+        if not self._inflight.acquire(blocking=False):
+            logging.info("VLM is busy")
+            return None
+
+        if isinstance(message, ChatMessages):
+            self._tasks.put((self._call_chat_completion, (ego, message, images, kwargs))) #pass kwargs as dict to callback 
+        if isinstance(message, str):
+            self._tasks.put((self._call_str, (ego, message, images, kwargs))) #pass kwargs as dict to callback 
\ No newline at end of file
@@ -15,7 +15,8 @@
 
 import requests 
 import argparse 
-import json 
+import orjson 
+from time import monotonic 
 
 __all__ = ["VST"]
 
@@ -25,13 +26,14 @@ class VST:
     Provides convenient functions to get streams from VST
     """
 
-    def __init__(self, url):
+    def __init__(self, url, cache_ttl=2):
         """
         Provide the URL to a VST server. 
         Ex)     url = http://0.0.0.0:81
                 VST(url)
         Args:
             url (string): Address of VST server. Ex) "http://0.0.0.0:81/"
+            cache_ttl (float): Seconds to reuse the last stream and sensor lists before requesting them from VST again. 
 
         Returns:
             None
@@ -41,14 +43,30 @@ class VST:
         self.rtsp_streams = []
         self.streams = []
         self.sensors = []
+        self._session = requests.Session() #reuse connections to VST across calls 
+        self.cache_ttl = cache_ttl 
+        self._streams_time = None #monotonic time the stream list was last fetched
+        self._sensors_time = None #monotonic time the sensor list was last fetched
 
 
     def _update_streams(self):
-        streams = requests.get(f"{self.url}api/v1/live/streams")
+        if self._streams_time is not None and monotonic() - self._streams_time < self.cache_ttl:
+            return 
+        streams = self._session.get(f"{self.url}api/v1/live/streams")
         self.streams = streams.json()
+        self._streams_time = monotonic()
+
     def _update_sensors(self):
-        sensors = requests.get(f"{self.url}api/v1/sensor/list")
+        if self._sensors_time is not None and monotonic() - self._sensors_time < self.cache_ttl:
+            return 
+        sensors = self._session.get(f"{self.url}api/v1/sensor/list")
         self.sensors = sensors.json()
+        self._sensors_time = monotonic()
+
+    def _invalidate_cache(self):
+        """Force the next stream and sensor lookups to request VST after sensors are added or removed."""
+        self._streams_time = None 
+        self._sensors_time = None 
         
     def add_rtsp_stream(self, url, name, location=""):
         """
@@ -63,8 +81,9 @@ class VST:
             none
         """
         stream_info = {"sensorUrl":url, "name":name, "username":"", "password":"", "location":location}
-        stream_info = json.dumps(stream_info)
-        resp = requests.post(f"{self.url}api/v1/sensor/add", data=stream_info)
+        stream_info = orjson.dumps(stream_info)
+        resp = self._session.post(f"{self.url}api/v1/sensor/add", data=stream_info)
+        self._invalidate_cache()
         return resp 
 
     def remove_rtsp_stream(self, sensorId):
@@ -77,7 +96,8 @@ class VST:
         Returns:
             none
         """
-        requests.delete(f"{self.url}api/v1/sensor/{sensorId}")
+        self._session.delete(f"{self.url}api/v1/sensor/{sensorId}")
+        self._invalidate_cache()
 
     def get_sensor_id(self, name):
         """
@@ -120,17 +140,12 @@ class VST:
         """
 
         self._update_streams()
-        self.rtsp_streams = []
-        for stream in self.streams:
-            for streamID,v in stream.items():
-                stream_info = {"streamID":streamID}
-                for substream in v:
-                    if substream["isMain"]:
-                        url = substream["url"]
-                        if url != "":
-                            stream_info["name"] = substream["name"]
-                            stream_info["url"] = url
-                            self.rtsp_streams.append(stream_info)
+        #Use the first main substream with a URL for each stream 
+        self.rtsp_streams = [
+            {"streamID": streamID, "name": main["name"], "url": main["url"]}
+            for stream in self.streams for streamID, v in stream.items()
+            if (main := next((substream for substream in v if substream["isMain"] and substream["url"] != ""), None))
+        ]
     
         return self.rtsp_streams
 
@@ -15,4 +15,4 @@
 
 from setuptools import find_packages, setup
 
-setup(name="mmj_utils", version="1.1.0", packages=find_packages(), install_requires=["redis", "matplotlib", "numpy", "torch", "fastapi", "pydantic", "pillow", "prometheus-client", "uvicorn[standard]"])
\ No newline at end of file
+setup(name="mmj_utils", version="1.1.0", packages=find_packages(), install_requires=["redis", "orjson", "matplotlib", "numpy", "torch", "fastapi", "pydantic", "pillow", "prometheus-client", "uvicorn[standard]"])
\ No newline at end of file